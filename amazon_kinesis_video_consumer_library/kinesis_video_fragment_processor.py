@@ -15,19 +15,55 @@ __copyright__ = "Copyright Amazon.com, Inc. or its affiliates. All Rights Reserv
 __author__ = "Dean Colcott <https://www.linkedin.com/in/deancolcott/>"
 
 import io
+import os
 import cv2
 import wave
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import av
+import numpy as np
+from av.video.reformatter import VideoReformatter
 from PIL import Image
-import imageio.v3 as iio
 import amazon_kinesis_video_consumer_library.ebmlite.util as emblite_utils
 import amazon_kinesis_video_consumer_library.ebmlite.decoding as ebmlite_decoding
 
+# libjpeg-turbo bindings are optional, Pillow is used for JPEG encoding when not installed.
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+except ImportError:
+    TurboJPEG = None
+
 # Init the logger.
 log = logging.getLogger(__name__)
 
+# JPEG quality used when converting frames to JPEG in memory.
+JPEG_QUALITY = 85
+
+# Frames assumed in a fragment when the container doesn't report its frame count (about 2 s at 30 fps).
+DEFAULT_FRAGMENT_FRAMES = 64
+
+# EBML master elements scan_tags_fast() descends into on the way to the SimpleTags: Segment, Tags and Tag.
+# Any other element with a known size (Cluster, SimpleBlock, Tracks...) is skipped in a single jump.
+_TAG_PATH_ELEMENT_IDS = (0x18538067, 0x1254C367, 0x7373)
+
 class KvsFragementProcessor():
 
+    def __init__(self):
+        '''
+        Initialize the fragment processor. Loads the libjpeg-turbo encoder once if available so
+        all in-memory JPEG conversions share it, and starts the thread pool they run on.
+        '''
+        # JPEG encodes and writes release the GIL, one long-lived pool runs them for every fragment
+        self._jpeg_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+        self._turbo_jpeg = None
+        if TurboJPEG is not None:
+            try:
+                self._turbo_jpeg = TurboJPEG()
+            except (OSError, RuntimeError) as err:
+                # PyTurboJPEG is installed but the native libturbojpeg library could not be loaded.
+                log.warning(f'libturbojpeg not available, falling back to Pillow JPEG encoding: {err}')
+
     ####################################################
     # Fragment processing functions
 
@@ -86,6 +122,92 @@ class KvsFragementProcessor():
                 simple_tags_dict[tag_name] = tag_value
 
         return simple_tags_dict
+
+    def scan_tags_fast(self, fragment_bytes, tag_names=None):
+        '''
+        Returns the SimpleTag elements of a raw MKV fragment without building the EBMLite DOM.
+
+        Walks the EBML elements of fragment_bytes in a single forward pass decoding only the element
+        IDs and sizes: the Segment, Tags and Tag masters are entered, every other element is jumped over
+        by its size so the frame data in the Clusters is never touched. Masters of unknown size (as used
+        by streamed Segments and Clusters) are entered too, their children are read as siblings.
+
+        ### Parameters:
+
+            **fragment_bytes**: bytearray | bytes
+                A single MKV fragment as returned to the on_fragment_arrived callback by KvsParser.
+
+            **tag_names**: set<String>, optional
+                If given, only these tags are returned and the scan stops as soon as all of them are found.
+                Default None, all SimpleTags in the fragment.
+
+        ### Returns:
+
+            simple_tags: dict
+
+            Dictionary of the SimpleTag elements with format - TagName<String> : TagValue <String | Binary>,
+            the same format as get_fragment_tags().
+
+        '''
+
+        data = memoryview(fragment_bytes)
+        end = len(data)
+        position = 0
+
+        simple_tags_dict = {}
+        while position < end:
+            element_id, position = self._read_ebml_id(data, position)
+            size, position = self._read_ebml_size(data, position)
+
+            if (element_id == 0x67C8):                                  # SimpleTag element type ID
+                tag_name, tag_value = self._read_simple_tag(data, position, min(position + size, end))
+                if (tag_name and (tag_names is None or tag_name in tag_names)):
+                    simple_tags_dict[tag_name] = tag_value
+                    if (tag_names is not None and len(simple_tags_dict) == len(tag_names)):
+                        break
+                position += size
+            elif (size is None or element_id in _TAG_PATH_ELEMENT_IDS):
+                continue                                                # Enter the master element
+            else:
+                position += size
+
+        return simple_tags_dict
+
+    def _read_simple_tag(self, data, position, end):
+        '''
+        Reads the TagName and TagString / TagBinary values from the payload of a SimpleTag element.
+        '''
+        tag_name = None
+        tag_value = None
+        while position < end:
+            element_id, position = self._read_ebml_id(data, position)
+            size, position = self._read_ebml_size(data, position)
+            if (element_id == 0x45A3):                                  # Tag Name element type ID
+                tag_name = str(bytes(data[position:position + size]).partition(b'\x00')[0], 'utf-8')
+            elif (element_id == 0x4487):                                # TagString element type ID
+                tag_value = str(bytes(data[position:position + size]).partition(b'\x00')[0], 'utf-8')
+            elif (element_id == 0x4485):                                # TagBinary element type ID
+                tag_value = bytes(data[position:position + size])
+            position += size
+        return tag_name, tag_value
+
+    def _read_ebml_id(self, data, position):
+        '''
+        Decodes the EBML element ID at position. Returns the ID and the position of the element size.
+        '''
+        length, _ = ebmlite_decoding.decodeIDLength(data[position])
+        return int.from_bytes(data[position:position + length], 'big'), position + length
+
+    def _read_ebml_size(self, data, position):
+        '''
+        Decodes the EBML variable length element size at position. Returns the size (None when the
+        size is unknown) and the position of the element payload.
+        '''
+        length, size = ebmlite_decoding.decodeIntLength(data[position])
+        size = (size << (8 * (length - 1))) | int.from_bytes(data[position + 1:position + length], 'big')
+        if (size == (1 << (7 * length)) - 1):                           # All size bits set: unknown size
+            size = None
+        return size, position + length
     
     def get_fragement_dom_pretty_string(self, fragment_dom):
         '''
@@ -134,7 +256,8 @@ class KvsFragementProcessor():
         e.g: Setting one_in_frames_ratio = 5 will return every 5th frame found in the fragment.
         (Starting with the first)
 
-        To return all available frames just set one_in_frames_ratio = 1
+        To return all available frames just set one_in_frames_ratio = 1. With a ratio above 1 the
+        decoder skips non-reference frames, so the ratio applies to the reference frames only.
 
         ### Parameters:
 
@@ -146,20 +269,131 @@ class KvsFragementProcessor():
 
         ### Return:
 
-            frames: List<numpy.ndarray>
-            A list of frames extracted from the fragment as numpy.ndarray
+            frames: numpy.ndarray
+            The frames extracted from the fragment as one (N, H, W, 3) numpy.ndarray
         
         '''
 
-        # Parse all frames in the fragment to frames list
-        frames = iio.imread(io.BytesIO(fragment_bytes), plugin="pyav", index=...)
+        frames = None
+        frame_count = 0
+        with av.open(io.BytesIO(fragment_bytes)) as container:
+            video_stream = container.streams.video[0]
+            video_stream.thread_type = "AUTO"
+            if one_in_frames_ratio > 1:
+                # Non-reference frames (e.g. B-frames) aren't needed to decode the rest of the GOP,
+                # so when sub-sampling the decoder can drop them without decoding.
+                video_stream.codec_context.skip_frame = "NONREF"
+
+            # Frames are written straight into one contiguous (N, H, W, 3) block sized from the stream's
+            # frame count when the container reports it (KVS fragments usually don't), grown if it falls short.
+            expected_frames = video_stream.frames or DEFAULT_FRAGMENT_FRAMES
+            expected_frames = -(-expected_frames // one_in_frames_ratio)
+
+            # Only the frames in the requested ratio are converted to RGB
+            reformatter = VideoReformatter()
+            for frame_index, frame in enumerate(container.decode(video_stream)):
+                if frame_index % one_in_frames_ratio:
+                    continue
+                plane = reformatter.reformat(frame, format="rgb24").planes[0]
+
+                if frames is None:
+                    frames = np.empty((expected_frames, plane.height, plane.width, 3), dtype=np.uint8)
+                elif frame_count == len(frames):
+                    frames = np.concatenate((frames, np.empty_like(frames)))
+
+                # Copy the RGB plane into its slot, dropping any row padding (line_size >= width * 3)
+                rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+                frames[frame_count] = rows[:, :plane.width * 3].reshape(plane.height, plane.width, 3)
+                frame_count += 1
+
+        if frames is None:
+            return np.empty((0, 0, 0, 3), dtype=np.uint8)
+        return frames[:frame_count]
+
+    def get_motion_frames_as_ndarray(self, fragment_bytes, one_in_frames_ratio, scale):
+        '''
+        Decodes the fragment once for motion detection: returns the frames in the requested ratio as small
+        grayscale numpy.ndarray's plus the decoded frames themselves, so only the frames that turn out to
+        have motion are ever converted to full resolution RGB (with frame.to_ndarray(format="rgb24")).
 
-        # Store and return frames in frame ratio of total available 
-        ret_frames = []
-        for i in range(0, len(frames), one_in_frames_ratio):
-            ret_frames.append(frames[i])
+        The downscale and the gray conversion are done by libswscale in the same pass (INTER_AREA like
+        averaging), reading just the luma plane of the decoded YUV frames.
 
-        return ret_frames
+        ### Parameters:
+
+            fragment_bytes: bytearray
+                A ByteArray with raw bytes from exactly one fragment.
+
+            one_in_frames_ratio: int
+                Ratio of the available frames in the fragment to process and return, as in get_frames_as_ndarray.
+
+            scale: int
+                Linear downscale factor of the grayscale frames (e.g. 4 returns 480x270 frames for 1920x1080).
+
+        ### Return:
+
+            gray_frames: numpy.ndarray
+            The downscaled grayscale frames as one (N, H / scale, W / scale) numpy.ndarray
+
+            video_frames: List<av.VideoFrame>
+            The decoded frames matching gray_frames, still in the decoder's pixel format.
+        '''
+
+        gray_frames = None
+        video_frames = []
+        with av.open(io.BytesIO(fragment_bytes)) as container:
+            video_stream = container.streams.video[0]
+            video_stream.thread_type = "AUTO"
+            if one_in_frames_ratio > 1:
+                video_stream.codec_context.skip_frame = "NONREF"
+
+            expected_frames = video_stream.frames or DEFAULT_FRAGMENT_FRAMES
+            expected_frames = -(-expected_frames // one_in_frames_ratio)
+
+            reformatter = VideoReformatter()
+            for frame_index, frame in enumerate(container.decode(video_stream)):
+                if frame_index % one_in_frames_ratio:
+                    continue
+                plane = reformatter.reformat(frame, width=frame.width // scale, height=frame.height // scale,
+                                             format="gray", interpolation="AREA").planes[0]
+
+                if gray_frames is None:
+                    gray_frames = np.empty((expected_frames, plane.height, plane.width), dtype=np.uint8)
+                elif len(video_frames) == len(gray_frames):
+                    gray_frames = np.concatenate((gray_frames, np.empty_like(gray_frames)))
+
+                # Copy the gray plane into its slot, dropping any row padding (line_size >= width)
+                rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+                gray_frames[len(video_frames)] = rows[:, :plane.width]
+                video_frames.append(frame)
+
+        if gray_frames is None:
+            return np.empty((0, 0, 0), dtype=np.uint8), video_frames
+        return gray_frames[:len(video_frames)], video_frames
+
+    def get_keyframe_as_ndarray(self, fragment_bytes):
+        '''
+        Decodes only the first keyframe of the fragment and returns it as an RGB numpy.ndarray.
+        Non-key frames are skipped by the decoder, so this is much cheaper than get_frames_as_ndarray
+        and can be used as a coarse per-fragment check before a full decode.
+
+        ### Parameters:
+
+            fragment_bytes: bytearray
+                A ByteArray with raw bytes from exactly one fragment.
+
+        ### Return:
+
+            frame: numpy.ndarray
+            The first keyframe as an (H, W, 3) numpy.ndarray, or None if the fragment has no video frames.
+
+        '''
+        with av.open(io.BytesIO(fragment_bytes)) as container:
+            video_stream = container.streams.video[0]
+            video_stream.codec_context.skip_frame = "NONKEY"
+            for frame in container.decode(video_stream):
+                return frame.to_ndarray(format="rgb24")
+        return None
 
     def save_fragment_frames_as_jpeg(self, fragment_bytes, one_in_frames_ratio, jpg_file_base_path):
         '''
@@ -190,14 +424,7 @@ class KvsFragementProcessor():
         ndarray_frames = self.get_frames_as_ndarray(fragment_bytes, one_in_frames_ratio)
 
         # Write frames to disk as JPEG images
-        jpeg_paths = []
-        for i in range(len(ndarray_frames)):
-            frame = ndarray_frames[i]
-            image_file_path = '{}-{}.jpg'.format(jpg_file_base_path, i)
-            iio.imwrite(image_file_path, frame, format=None)
-            jpeg_paths.append(image_file_path)
-        
-        return jpeg_paths
+        return self.save_frames_as_jpeg(ndarray_frames, jpg_file_base_path)
   
     def save_frames_as_jpeg(self, ndarray_frames, jpg_file_base_path):
         '''
@@ -206,7 +433,10 @@ class KvsFragementProcessor():
         ### Parameters:
         
         ndarray_frames: List<numpy.ndarray>
-            A ByteArray with raw bytes from exactly one fragment.
+            RGB frames as returned by get_frames_as_ndarray.
+
+        jpg_file_base_path: Str
+            Base file path, each frame is saved as <jpg_file_base_path>-<index>.jpg
 
         ### Return
         
@@ -215,22 +445,24 @@ class KvsFragementProcessor():
         
         '''
 
-        # Write frames to disk as JPEG images
-        jpeg_paths = []
-        for i in range(len(ndarray_frames)):
-            frame = ndarray_frames[i]
-            image_file_path = '{}-{}.jpg'.format(jpg_file_base_path, i)
-            iio.imwrite(image_file_path, frame, format=None)
-            jpeg_paths.append(image_file_path)
+        # Write frames to disk as JPEG images. cv2.imwrite releases the GIL so encoding and disk I/O run in parallel.
+        jpeg_paths = ['{}-{}.jpg'.format(jpg_file_base_path, i) for i in range(len(ndarray_frames))]
+        list(self._jpeg_pool.map(self._write_jpeg, jpeg_paths, ndarray_frames))
         
         return jpeg_paths
+
+    def _write_jpeg(self, image_file_path, frame):
+        '''
+        Encodes an RGB frame and writes it to image_file_path as a JPEG.
+        '''
+        cv2.imwrite(image_file_path, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
   
     def get_frames_with_bounding_boxes(self, ndarray_frames, fragment_bounding_boxes):
         """
         Draws bounding boxes and labels on a list of frames.
 
         ### Parameters:
-            ndarray_frames: List of NumPy arrays representing frames.
+            ndarray_frames: List of NumPy arrays representing frames, all of the same shape (frames of one fragment).
             fragment_bounding_boxes: List of lists of dictionaries. Each list contains dictionaries with bounding box information for each frame:
                 frame_bboxes: List of dictionaries, where each dictionary contains:
                     - "name": Class label of the detected object.
@@ -238,61 +470,77 @@ class KvsFragementProcessor():
                     representing normalized coordinates (0-1).
 
         ### Return
-            List of NumPy arrays representing frames with bounding boxes and labels drawn.
+            (N, H, W, 3) NumPy array with the frames with bounding boxes and labels drawn,
+            (0, 0, 0, 3) if there are no frames.
         """
-        new_frames = []  # List to store frames with drawn bounding boxes and labels
-        for frame, frame_bboxes in zip(ndarray_frames, fragment_bounding_boxes):
-            # Create a copy of the frame to avoid modifying the original
-            frame_copy = frame.copy()
+        # One contiguous output block for all the frames (zip semantics: as many as frames with bounding boxes)
+        frame_count = min(len(ndarray_frames), len(fragment_bounding_boxes))
+        if frame_count == 0:
+            return np.empty((0, 0, 0, 3), dtype=np.uint8)
+        frame_shape = ndarray_frames[0].shape
+        if any(frame.shape != frame_shape for frame in ndarray_frames[1:frame_count]):
+            raise ValueError(f'All frames must have the same shape to be drawn into one block, the first is {frame_shape}')
+        new_frames = np.empty((frame_count,) + frame_shape, dtype=ndarray_frames[0].dtype)
+        height, width = new_frames.shape[1:3]
+
+        for frame_copy, frame, frame_bboxes in zip(new_frames, ndarray_frames, fragment_bounding_boxes):
+            # Copy the frame into its slot to avoid modifying the original
+            np.copyto(frame_copy, frame)
 
             for bbox in frame_bboxes:
-                # Get the dimensions of the frame
-                height, width, _ = frame_copy.shape
-
                 # Calculate the bounding box coordinates in pixels
                 x1 = int(bbox['Bounding_box']['Left'] * width)
                 y1 = int(bbox['Bounding_box']['Top'] * height)
                 x2 = int((bbox['Bounding_box']['Left'] + bbox['Bounding_box']['Width']) * width)
                 y2 = int((bbox['Bounding_box']['Top'] + bbox['Bounding_box']['Height']) * height)
 
-                # Draw the bounding box rectangle on the frame
-                cv2.rectangle(frame_copy, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                # Draw the bounding box rectangle on the frame (in place, LINE_8: no antialiasing)
+                cv2.rectangle(frame_copy, (x1, y1), (x2, y2), (0, 255, 0), 2, cv2.LINE_8)
 
                 # Add the class label text above the bounding box
-                cv2.putText(frame_copy, bbox['Name'], (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+                cv2.putText(frame_copy, bbox['Name'], (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2, cv2.LINE_8)
 
-            # Append the modified frame to the list
-            new_frames.append(frame_copy)
         return new_frames
 
 
-    def get_ndarray_frames_to_jpeg(self, frames):
+    def get_ndarray_frames_to_jpeg(self, frames, max_edge=None):
         """
         Converts a list of NumPy arrays (frames) into JPEG images.
 
         ### Parameters:
             frames: List of NumPy arrays representing frames.
+            max_edge: Optional. Frames with a longer side above max_edge pixels are downscaled (keeping
+                the aspect ratio) before encoding, for smaller uploads and cheaper encodes.
 
         ### Return
             frames_jpeg: List of bytes representing the generated JPEG images.
         """
-        frames_jpeg = []  # List to store JPEG image bytes
-        for frame in frames:
-            # Create a Pillow image from the NumPy array
-            image = Image.fromarray(frame)
-
-            # Create an in-memory buffer to store the image
-            buffer = io.BytesIO()
+        # Both libjpeg-turbo and Pillow release the GIL while encoding, so frames are encoded in parallel.
+        if len(frames) < 2:
+            return [self._encode_jpeg(frame, max_edge) for frame in frames]
+        return list(self._jpeg_pool.map(self._encode_jpeg, frames, [max_edge] * len(frames)))
 
-            # Save the image to the buffer in JPEG format
-            image.save(buffer, format="JPEG")
-
-            # Reset the buffer pointer to the beginning
-            buffer.seek(0)
-
-            # Read the JPEG image bytes and append them to the list
-            frames_jpeg.append(buffer.read())
-        return frames_jpeg
+    def _encode_jpeg(self, frame, max_edge=None):
+        '''
+        Encodes one RGB frame as JPEG bytes, downscaling it first to fit max_edge if given.
+        '''
+        if max_edge is not None:
+            height, width = frame.shape[:2]
+            scale = max_edge / max(height, width)
+            if scale < 1:
+                frame = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+        if self._turbo_jpeg is not None:
+            # libjpeg-turbo SIMD encoder straight from the RGB ndarray, no intermediate Pillow image.
+            return self._turbo_jpeg.encode(frame, quality=JPEG_QUALITY, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+
+        # Create a Pillow image from the NumPy array
+        image = Image.fromarray(frame)
+
+        # Save the image to an in-memory buffer in JPEG format
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+        return buffer.getvalue()
 
 
     def get_raw_audio_track_from_simple_block(self, mkv_element):
@@ -57,9 +57,14 @@ class KvsParser(Thread):
                 get_media_response_object, 
                 on_fragment_arrived, 
                 on_read_stream_complete, 
-                on_read_stream_exception):
+                on_read_stream_exception,
+                chunk_size=1024):
         '''
             Initialize the KVS media consumer library
+
+            chunk_size is the number of bytes read from the GetMedia streaming body per iteration. Each read
+            re-parses the buffered fragment, so larger reads mean fewer parses and socket reads, but a read only
+            returns once chunk_size bytes have arrived, which on a live stream delays fragment delivery.
         '''
         # Call the Thread class's init function
         Thread.__init__(self)
@@ -74,6 +79,7 @@ class KvsParser(Thread):
         self.on_fragment_arrived_callback = on_fragment_arrived
         self.on_read_stream_complete_callback = on_read_stream_complete
         self.on_read_stream_exception = on_read_stream_exception
+        self.chunk_size = chunk_size
 
         log.info('Loading EBMLlite MKV Schema....')
         self.schema = loadSchema('matroska.xml')
@@ -158,8 +164,8 @@ class KvsParser(Thread):
 
             chunk_read_count = 0
             
-            # Uses the StreamingBody object iterator to read in (default 1024 byte) chunks from the streaming buffer.
-            for chunk in kvs_streaming_buffer:
+            # Uses the StreamingBody chunk iterator to read in chunk_size byte chunks from the streaming buffer.
+            for chunk in kvs_streaming_buffer.iter_chunks(self.chunk_size):
 
                 if self._stop_get_media:
                     break
@@ -180,7 +186,8 @@ class KvsParser(Thread):
                 ebml_header_elements = self._get_ebml_header_elements(fragement_intrum_dom)
 
                 # If multiple fragment headers then the first fragment has been received completely and ready to process.
-                if (len(ebml_header_elements) > 1):
+                # A large chunk can complete several fragments, so loop until only the partial one is left in the buffer.
+                while (len(ebml_header_elements) > 1):
                     
                     # Get the offset for the first and second fragments. First fragment offset should be zero or fragment boundary is out of sync!
                     first_ebml_header_offset = ebml_header_elements[0].offset 
@@ -201,14 +208,17 @@ class KvsParser(Thread):
                                                       fragment_dom, 
                                                       fragment_receive_duration)
 
-                    # Remove the processed MKV segment from the raw byte chunk_buffer
-                    chunk_buffer = chunk_buffer[second_ebml_header_offset: ]
+                    # Remove the processed MKV segment from the raw byte chunk_buffer in place (no new bytearray copy)
+                    del chunk_buffer[:second_ebml_header_offset]
 
                     # Reset the chunk read count. 
                     chunk_read_count = 0
 
                     # Reset the start time for the next segment iteration just to time fragment durations
                     fragment_read_start_time = timeit.default_timer()
+
+                    # Look for further complete fragments in the remaining buffer
+                    ebml_header_elements = self._get_ebml_header_elements(self.schema.loads(chunk_buffer))
                 
                 #############################################
                 # Increment to chunk read count for this fragment
@@ -1,11 +1,11 @@
 import timeit  # Permite medir tiempos de ejecución
+from functools import partial  # Fija los parámetros de conversión una vez por stream
 import logging  # Permite generar logs para el monitoreo del proceso
-from threading import Thread  # Herramienta para trabajar con hilos
-from queue import Queue  # Cola que facilita la comunicación entre hilos
+from threading import Thread, Event  # Herramientas para trabajar con hilos
+from collections import deque  # Cola que facilita la comunicación entre hilos
+import numpy as np  # Bloques de frames preasignados
 import av  # PyAV: Librería para decodificar archivos multimedia (MKV en este caso)
-import imageio.v3 as iio  # Procesamiento de imágenes y video
-import io  # Permite manejar datos en buffers de memoria
-import numpy as np  # Librería para operaciones numéricas y manejo eficiente de arrays
+from av.video.reformatter import VideoReformatter  # Conversión de formato de píxel reutilizable
 
 # Inicialización del logger para reportar eventos, errores y procesos.
 log = logging.getLogger(__name__)
@@ -21,16 +21,25 @@ class MkvParser(Thread):
                  on_fragment_arrived, 
                  on_read_stream_complete, 
                  on_read_stream_exception,
-                 frame_group_size=60):
+                 frame_group_size=60,
+                 pixel_format="bgr24",
+                 one_in_frames_ratio=1):
         '''
         Constructor de MkvParser: Inicializa parámetros y callbacks necesarios.
 
         Parámetros:
             mkv_file_path (str): Ruta del archivo MKV a procesar.
             on_fragment_arrived (function): Callback cuando un fragmento es procesado y listo.
+                Recibe (frames, fragment_dom, fragment_receive_duration), con frames como numpy.ndarray (N, H, W, 3)
+                para bgr24/rgb24 o como lista de numpy.ndarray para formatos planares.
             on_read_stream_complete (function): Callback cuando se finaliza la lectura del archivo.
             on_read_stream_exception (function): Callback cuando ocurre una excepción durante el proceso.
             frame_group_size (int): Cantidad de frames que se agruparán por fragmento. (Default: 60)
+            pixel_format (str): Formato de píxel de los frames entregados. "bgr24" da arrays (H, W, 3);
+                "yuv420p" entrega el formato nativo del decodificador, (H * 3 / 2, W) con el plano Y
+                en las primeras H filas, sin conversión de color. (Default: "bgr24")
+            one_in_frames_ratio (int): Solo uno de cada N frames decodificados se convierte a numpy.ndarray y se
+                entrega; el resto se decodifica (lo exige el códec) pero nunca se materializa. (Default: 1, todos)
         '''
         Thread.__init__(self)  # Inicializa la clase Thread
         self._stop_get_media = False  # Bandera para detener el proceso de lectura
@@ -41,9 +50,17 @@ class MkvParser(Thread):
         self.on_read_stream_complete_callback = on_read_stream_complete
         self.on_read_stream_exception = on_read_stream_exception
         self.frame_group_size = frame_group_size
+        self.pixel_format = pixel_format
+        self.one_in_frames_ratio = one_in_frames_ratio
 
-        # Cola que almacena fragmentos de frames para ser procesados
-        self.frame_queue = Queue()
+        # Cola que almacena fragmentos de frames para ser procesados. Hay un único productor (run) y un
+        # único consumidor (process_queue): deque.append/popleft son atómicos, así que basta un Event para
+        # despertar al consumidor, sin el Lock + Condition que Queue adquiere en cada put/get.
+        self.frame_queue = deque()
+        self._frames_ready = Event()
+
+        # Reformateador único para todo el stream: evita crear un VideoReformatter por frame
+        self._reformatter = VideoReformatter()
 
     def stop_thread(self):
         """
@@ -60,30 +77,50 @@ class MkvParser(Thread):
             log.info(f'Reading MKV file: {self.mkv_file_path}')
             container = av.open(self.mkv_file_path)  # Abre el archivo MKV con PyAV
 
+            # Decodificación multihilo de libav: AUTO usa hilos por frame y por slice, thread_count = 0 usa
+            # todos los núcleos. Si importa la latencia por frame, "SLICE" evita el retardo de los hilos por frame.
+            video_stream = container.streams.video[0]
+            video_stream.thread_type = "AUTO"
+            video_stream.thread_count = 0
+
+            # Conversión de formato especializada para este stream
+            reformat = self._make_reformat(video_stream)
+
             # Inicializa un hilo trabajador que procesa la cola de frames
             worker_thread = Thread(target=self.process_queue)
             worker_thread.start()
 
-            frames_accumulated = []  # Lista temporal para acumular frames
+            frames_accumulated = None  # Bloque (o lista) con los frames del grupo actual
+            frames_stored = 0  # Frames ya guardados en el bloque del grupo actual
+            frames_decoded = 0  # Frames decodificados en el grupo actual
 
             # Itera sobre los frames decodificados del archivo
             for frame in container.decode(video=0):  # Decodifica el primer stream de video (video=0)
                 if self._stop_get_media:  # Verifica si debe detenerse la lectura
                     break
 
-                frames_accumulated.append(frame)  # Agrega el frame actual a la lista acumulada
-
-                # Si la lista alcanza el tamaño del grupo, la envía a la cola
-                if len(frames_accumulated) >= self.frame_group_size:
-                    self.frame_queue.put(frames_accumulated)
-                    frames_accumulated = []  # Reinicia la lista acumuladora
+                # Solo se convierten a numpy.ndarray los frames que se van a entregar
+                if frames_decoded % self.one_in_frames_ratio == 0:
+                    frame = reformat(frame)
+                    if frames_accumulated is None:  # Primer frame del grupo: reserva el bloque completo
+                        frames_accumulated = self._allocate_group(frame)
+                    self._store_frame(frames_accumulated, frames_stored, frame)
+                    frames_stored += 1
+                frames_decoded += 1
+
+                # Si el grupo alcanza el tamaño (en frames decodificados), lo envía a la cola
+                if frames_decoded >= self.frame_group_size:
+                    self._put_frames(frames_accumulated[:frames_stored])
+                    frames_accumulated = None  # El siguiente grupo reserva un bloque nuevo
+                    frames_stored = 0
+                    frames_decoded = 0
 
             # Envía los frames restantes (si hay) a la cola
-            if frames_accumulated:
-                self.frame_queue.put(frames_accumulated)
+            if frames_stored:
+                self._put_frames(frames_accumulated[:frames_stored])
 
             # Envía señal de finalización al trabajador
-            self.frame_queue.put(None)
+            self._put_frames(None)
             worker_thread.join()  # Espera a que el hilo trabajador finalice
 
             log.info('Stream parsing completed successfully.')
@@ -94,64 +131,119 @@ class MkvParser(Thread):
             log.error(f'Error processing MKV stream: {e}', exc_info=True)
             self.on_read_stream_exception(str(e))
 
-    def process_queue(self):
+    def _put_frames(self, item):
         """
-        Procesa los fragmentos de frames almacenados en la cola.
-        Convierte los frames en bytes y simula procesamiento adicional.
+        Encola un grupo de frames (o None para finalizar) y despierta al hilo trabajador.
+
+        Parámetros:
+            item (numpy.ndarray | list | None): Frames del fragmento, o None como señal de fin.
         """
-        while True:
-            start_time = timeit.default_timer()  # Marca el tiempo inicial del procesamiento
-            item = self.frame_queue.get()  # Obtiene un fragmento de frames de la cola
+        self.frame_queue.append(item)
+        self._frames_ready.set()
 
-            if item is None:  # Si recibe None, finaliza el procesamiento
-                break
+    def _make_reformat(self, video_stream):
+        """
+        Construye, una sola vez por stream, la función que lleva cada frame al formato de píxel
+        configurado. El formato del stream no cambia durante la lectura, así que la comparación
+        de formatos y los parámetros del reformateador se resuelven aquí y no en cada frame.
 
-            frames = item  # Lista de frames del fragmento actual
+        Parámetros:
+            video_stream (av.VideoStream): Stream de video del contenedor abierto.
 
-            # Convierte los frames a un único buffer de bytes
-            combined_buffer = self.frames_to_bytes(frames)
-            fragment_receive_duration = timeit.default_timer() - start_time  # Tiempo total del procesamiento
+        Retorna:
+            function: Recibe un av.VideoFrame y lo devuelve en formato self.pixel_format.
+        """
+        if video_stream.codec_context.pix_fmt == self.pixel_format:
+            return lambda frame: frame  # El decodificador ya entrega el formato pedido
+        return partial(self._reformatter.reformat, format=self.pixel_format)
 
-            # Simula procesamiento y genera un objeto "DOM"
-            fragment_dom = self.process_frame_to_dom(combined_buffer)
+    def _allocate_group(self, frame):
+        """
+        Reserva el almacenamiento de un grupo a partir de su primer frame. Para formatos empaquetados
+        de un solo plano (bgr24/rgb24) es un único numpy.ndarray (N, H, W, 3) donde se copia cada frame;
+        para formatos planares (yuv420p) es una lista que se llena con to_ndarray().
 
-            # Llama al callback con el fragmento procesado y sus metadatos
-            self.on_fragment_arrived_callback(
-                combined_buffer,
-                fragment_dom,
-                fragment_receive_duration
-            )
+        El bloque no se reutiliza entre grupos: el hilo trabajador y el callback siguen usando los
+        frames del grupo anterior mientras se decodifica el siguiente.
 
-    def frames_to_bytes(self, frames):
-        """
-        Convierte una lista de av.VideoFrame en un único buffer de bytes.
-        
         Parámetros:
-            frames (list): Lista de frames (av.VideoFrame) a convertir.
+            frame (av.VideoFrame): Primer frame del grupo, ya en formato self.pixel_format.
 
         Retorna:
-            bytes: Buffer combinado de los frames en formato JPEG.
+            numpy.ndarray | list: Almacenamiento para los frames entregables del grupo.
         """
-        combined_buffer = io.BytesIO()  # Crea un buffer en memoria
-        for frame in frames:
-            # Convierte cada frame a una imagen JPEG y lo guarda en el buffer
-            frame.to_image().save(combined_buffer, format="jpeg")
-        return combined_buffer.getvalue()  # Devuelve el buffer como bytes
+        group_size = -(-self.frame_group_size // self.one_in_frames_ratio)  # Frames entregables por grupo
+        if frame.format.name in ("bgr24", "rgb24"):
+            return np.empty((group_size, frame.height, frame.width, 3), dtype=np.uint8)
+        return [None] * group_size
+
+    def _store_frame(self, frames_accumulated, index, frame):
+        """
+        Guarda un frame en la posición index del grupo. En el bloque ndarray copia el plano
+        directamente desde el buffer de libav, sin el array intermedio de to_ndarray().
+
+        Parámetros:
+            frames_accumulated (numpy.ndarray | list): Almacenamiento devuelto por _allocate_group.
+            index (int): Posición del frame dentro del grupo.
+            frame (av.VideoFrame): Frame en formato self.pixel_format.
+        """
+        if isinstance(frames_accumulated, list):
+            frames_accumulated[index] = frame.to_ndarray()
+            return
+        plane = frame.planes[0]
+        # Las filas del plano pueden traer relleno (line_size >= width * 3): se descarta al copiar
+        rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+        frames_accumulated[index] = rows[:, :plane.width * 3].reshape(plane.height, plane.width, 3)
+
+    def process_queue(self):
+        """
+        Procesa los fragmentos de frames almacenados en la cola.
+        Entrega los frames (bloque o lista de numpy.ndarray) junto con sus metadatos.
+        """
+        start_time = timeit.default_timer()  # Marca el tiempo inicial del procesamiento
+        while True:
+            # Espera a que el productor encole algo. El Event se limpia antes de vaciar la cola, así un
+            # set() posterior nunca se pierde.
+            self._frames_ready.wait()
+            self._frames_ready.clear()
+
+            while self.frame_queue:
+                item = self.frame_queue.popleft()  # Obtiene un fragmento de frames de la cola
+
+                if item is None:  # Si recibe None, finaliza el procesamiento
+                    return
+
+                frames = item  # Frames (numpy.ndarray) del fragmento actual
+                fragment_receive_duration = timeit.default_timer() - start_time  # Tiempo total del procesamiento
+
+                # Simula procesamiento y genera un objeto "DOM"
+                fragment_dom = self.process_frame_to_dom(frames)
+
+                # Llama al callback con los frames del fragmento y sus metadatos
+                self.on_fragment_arrived_callback(
+                    frames,
+                    fragment_dom,
+                    fragment_receive_duration
+                )
+                start_time = timeit.default_timer()
 
-    def process_frame_to_dom(self, fragment_bytes):
+    def process_frame_to_dom(self, frames):
         """
         Simula el procesamiento del fragmento y genera una estructura con metadatos.
 
         Parámetros:
-            fragment_bytes (bytes): Datos binarios del fragmento procesado.
+            frames (numpy.ndarray | list): Frames (numpy.ndarray) del fragmento procesado.
 
         Retorna:
             dict: Estructura con datos del fragmento y metadatos.
         """
         return {
-            "raw_bytes": fragment_bytes,
+            "frames": frames,
             "metadata": {
-                "size": len(fragment_bytes),  # Tamaño del fragmento en bytes
+                "frame_count": len(frames),  # Cantidad de frames del fragmento
+                "pix_fmt": self.pixel_format,  # Formato de píxel de los frames
+                "shape": frames[0].shape,  # Dimensiones de cada frame
+                "size": sum(frame.nbytes for frame in frames),  # Tamaño del fragmento en bytes
                 "timestamp": timeit.default_timer(),  # Marca de tiempo del procesamiento
             }
         }
@@ -1,17 +1,125 @@
-import io
+import os
 import cv2
 import logging
 import numpy as np
-import imageio.v3 as iio
+from concurrent.futures import ThreadPoolExecutor
+# Misma calidad JPEG que KvsFragementProcessor, definida en un solo sitio
+from amazon_kinesis_video_consumer_library.kinesis_video_fragment_processor import JPEG_QUALITY
+
+# Numba is optional, a vectorized NumPy/OpenCV path is used when not installed.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 # Init the logger.
 log = logging.getLogger(__name__)
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _count_motion_pixels(prev_frame, frame, threshold):
+        '''
+        Counts the pixels whose absolute difference between two grayscale frames is above threshold.
+        absdiff, threshold and count are fused into a single pass over both frames: rows are split
+        across threads with prange and each row is a tight loop the compiler can vectorize.
+        cache=True keeps the compiled kernel on disk between runs. nogil=True releases the GIL while
+        the kernel runs, so the other consumer threads (stream reader, Rekognition, websocket) keep going.
+        '''
+        height, width = frame.shape
+        count = 0
+        for y in prange(height):
+            row_count = 0
+            for x in range(width):
+                if abs(np.int16(frame[y, x]) - np.int16(prev_frame[y, x])) > threshold:
+                    row_count += 1
+            count += row_count
+        return count
+
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _count_motion_pixels_3(prev_frame, frame, next_frame, threshold):
+        '''
+        Three-frame variant of _count_motion_pixels: counts the pixels of frame that differ by more than
+        threshold from both prev_frame and next_frame. A pixel that changed only once (a shadow or light
+        change that stays, the background uncovered behind an object) isn't counted.
+        '''
+        height, width = frame.shape
+        count = 0
+        for y in prange(height):
+            row_count = 0
+            for x in range(width):
+                value = np.int16(frame[y, x])
+                if (abs(value - np.int16(prev_frame[y, x])) > threshold
+                        and abs(np.int16(next_frame[y, x]) - value) > threshold):
+                    row_count += 1
+            count += row_count
+        return count
+
+    # Compile (or load from the cache) at import time so the first fragment doesn't pay the JIT latency.
+    _count_motion_pixels(np.zeros((1, 1), np.uint8), np.zeros((1, 1), np.uint8), 0)
+    _count_motion_pixels_3(np.zeros((1, 1), np.uint8), np.zeros((1, 1), np.uint8), np.zeros((1, 1), np.uint8), 0)
+
+
+def _motion_pixel_counts(gray_frames, threshold):
+    '''
+    Returns, for every frame after the first, the number of pixels that changed more than threshold
+    with respect to the previous frame.
+    '''
+    if njit is not None:
+        return np.array([_count_motion_pixels(prev_frame, frame, threshold)
+                         for prev_frame, frame in zip(gray_frames, gray_frames[1:])])
+
+    # Without Numba diff all consecutive pairs at once: frames are stacked as (N, H*W) rows
+    # so a single uint8 cv2.absdiff covers every pair, no int16 temporaries.
+    stack = np.stack(gray_frames).reshape(len(gray_frames), -1)
+    diffs = cv2.absdiff(stack[1:], stack[:-1])
+    return np.count_nonzero(diffs > threshold, axis=1)
+
+def _three_frame_motion_pixel_counts(gray_frames, threshold):
+    '''
+    Returns, for every frame except the first and the last, the number of pixels that changed more than
+    threshold with respect to both the previous and the next frame.
+    '''
+    if njit is not None:
+        return np.array([_count_motion_pixels_3(prev_frame, frame, next_frame, threshold)
+                         for prev_frame, frame, next_frame in zip(gray_frames, gray_frames[1:], gray_frames[2:])])
+
+    stack = np.stack(gray_frames).reshape(len(gray_frames), -1)
+    changed = cv2.absdiff(stack[1:], stack[:-1]) > threshold
+    return np.count_nonzero(changed[:-1] & changed[1:], axis=1)
+
+def _write_jpeg(image_file_path, frame):
+    '''
+    Encodes a BGR frame and writes it to image_file_path as a JPEG.
+    '''
+    cv2.imwrite(image_file_path, frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+
+
 class MotionDetector():
 
-    def get_frames_as_ndarray(self, fragment_bytes, one_in_frames_ratio):
+    def __init__(self, mask_path=None):
         '''
-        Parses fragment_bytes and returns a ratio of available frames in the MKV fragment as
+        ### Parámetros:
+        - mask_path: str, opcional
+            Imagen en escala de grises con las zonas a vigilar en blanco y las zonas a ignorar (árboles,
+            reflejos, una calle) en negro. Se reescala al tamaño de los frames analizados y los píxeles
+            en negro nunca cuentan como movimiento. Default es None (sin máscara).
+        '''
+        self._mask = None
+        self._scaled_masks = {}  # Máscara reescalada por tamaño de frame (alto, ancho)
+        if mask_path is not None:
+            mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+            if mask is None:
+                raise ValueError(f'Motion mask could not be read: {mask_path}')
+            _, self._mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+
+        # Modelo de fondo de background_subtraction, se crea en la primera llamada y persiste entre fragmentos
+        self._background_subtractor = None
+        # Pool de escritura de JPEG, se reutiliza en cada llamada a save_frames_as_jpeg
+        self._jpeg_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+    def get_frames_as_ndarray(self, frames, one_in_frames_ratio):
+        '''
+        Returns a ratio of the decoded frames delivered by the MkvParser as
         a list of numpy.ndarray's.
 
         e.g: Setting one_in_frames_ratio = 5 will return every 5th frame found in the fragment.
@@ -21,8 +129,8 @@ class MotionDetector():
 
         ### Parameters:
 
-            fragment_bytes: bytearray
-                A ByteArray with raw bytes from exactly one fragment.
+            frames: List<numpy.ndarray>
+                Decoded BGR frames from exactly one fragment as delivered by MkvParser.
 
             one_in_frames_ratio: Str
                 Ratio of the available frames in the fragment to process and return.
@@ -34,15 +142,27 @@ class MotionDetector():
         
         '''
 
-        # Parse all frames in the fragment to frames list
-        frames = iio.imread(io.BytesIO(fragment_bytes), plugin="pyav", index=...)
-        log.info(f"HAY {len(frames)}FRAMES")
-        # Store and return frames in frame ratio of total available 
-        ret_frames = []
-        for i in range(0, len(frames), one_in_frames_ratio):
-            ret_frames.append(frames[i])
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"HAY {len(frames)} FRAMES")
+        # Return frames in frame ratio of total available (a strided view when frames is an ndarray block)
+        return frames[::one_in_frames_ratio]
+
+    def get_luma_planes(self, yuv_frames):
+        '''
+        Returns the luma (Y) plane of each yuv420p frame delivered by MkvParser(pixel_format="yuv420p").
+        The Y plane is already a grayscale image, so it can be passed straight to frame_differencing.
+
+        ### Parameters:
+
+            yuv_frames: List<numpy.ndarray>
+                yuv420p frames of shape (H * 3 / 2, W).
 
-        return ret_frames
+        ### Return:
+
+            frames: List<numpy.ndarray>
+            Zero-copy (H, W) views on the luma plane of each frame.
+        '''
+        return [frame[:frame.shape[0] * 2 // 3] for frame in yuv_frames]
 
     def save_frames_as_jpeg(self, ndarray_frames, jpg_file_base_path):
         '''
@@ -51,7 +171,7 @@ class MotionDetector():
         ### Parameters:
 
         ndarray_frames: List<numpy.ndarray>
-            A ByteArray with raw bytes from exactly one fragment.
+            BGR frames as returned by get_frames_as_ndarray.
 
         ### Return
         jpeg_paths : List<Str>
@@ -59,57 +179,161 @@ class MotionDetector():
         
         '''
 
-        # Write frames to disk as JPEG images
-        jpeg_paths = []
-        for i in range(len(ndarray_frames)):
-            frame = ndarray_frames[i]
-            image_file_path = '{}-{}.jpg'.format(jpg_file_base_path, i)
-            iio.imwrite(image_file_path, frame, format=None)
-            jpeg_paths.append(image_file_path)
+        # Write frames to disk as JPEG images. Los frames ya son BGR, el orden que espera cv2.imwrite;
+        # cv2 libera el GIL, así que la codificación y la escritura a disco corren en paralelo.
+        jpeg_paths = ['{}-{}.jpg'.format(jpg_file_base_path, i) for i in range(len(ndarray_frames))]
+        list(self._jpeg_pool.map(_write_jpeg, jpeg_paths, ndarray_frames))
         
         return jpeg_paths
 
-    def frame_differencing(self, frames, threshold=90, min_motion_pixels=1500):
+    def frame_differencing(self, frames, threshold=90, min_motion_pixels=1500, scale=4, min_blob_area=None,
+                           three_frame=False):
         """
         Analiza una lista de frames para detectar movimiento.
 
         ### Parámetros:
         - frames: List[numpy.ndarray]
-            Lista de frames en formato numpy.ndarray (preprocesados).
+            Lista de frames en formato numpy.ndarray (preprocesados). Frames BGR (H, W, 3) se
+            convierten a escala de grises; frames de un solo canal (H, W), p. ej. el plano Y
+            de get_luma_planes, se usan directamente.
         - threshold: int, opcional
-            Umbral para la diferencia de píxeles entre frames. Default es 30.
+            Umbral para la diferencia de píxeles entre frames. Default es 90.
         - min_motion_pixels: int, opcional
-            Número mínimo de píxeles cambiados para considerar que hay movimiento. Default es 500.
+            Número mínimo de píxeles cambiados (a resolución completa) para considerar que hay
+            movimiento. Default es 1500.
+        - scale: int, opcional
+            Factor de reducción lineal antes de comparar: con 4 se comparan 16 veces menos píxeles.
+            min_motion_pixels se ajusta por scale ** 2. Default es 4 (1 para no reducir).
+        - min_blob_area: int, opcional
+            Área mínima (en píxeles a resolución completa) de una región conexa de movimiento. Si se
+            indica, los frames que superan min_motion_pixels solo cuentan como movimiento si al menos
+            una región alcanza ese tamaño, lo que descarta cambios dispersos (LEDs, sombras de hojas).
+            Default es None (sin filtro).
+        - three_frame: bool, opcional
+            Diferencia de tres frames: un píxel solo cuenta como movimiento del frame k si cambia respecto
+            al frame k - 1 y al frame k + 1. Descarta cambios que persisten (sombras, cambios de luz, el fondo
+            que deja un objeto) a cambio de no evaluar el primer ni el último frame. Default es False.
 
         ### Retorno:
-        - motion_frames: List[int]
-            Lista de índices de los frames donde se detectó movimiento.
+        - motion_frames: List[numpy.ndarray]
+            Frames (a resolución completa) donde se detectó movimiento.
+        """
+        motion_indices = self.frame_differencing_indices(frames, threshold, min_motion_pixels, scale, min_blob_area,
+                                                         three_frame)
+        return [frames[i] for i in motion_indices]
+
+    def frame_differencing_indices(self, frames, threshold=90, min_motion_pixels=1500, scale=4, min_blob_area=None,
+                                   three_frame=False):
+        """
+        Igual que frame_differencing, pero devuelve los índices (en frames) de los frames con movimiento.
+        Permite detectar movimiento sobre frames reducidos y materializar a resolución completa solo esos
+        frames (ver KvsFragementProcessor.get_motion_frames_as_ndarray): en ese caso se usa scale=1 y los
+        umbrales se expresan en píxeles de los frames reducidos.
+        """
+        if len(frames) < (3 if three_frame else 2):
+            return []
+
+        # Reducir y convertir cada frame a escala de grises una sola vez (los frames de un solo canal ya lo están).
+        # Se reduce antes de convertir: cvtColor trabaja sobre scale ** 2 veces menos píxeles.
+        gray_frames = [self._to_small_gray(frame, scale) for frame in frames]
+
+        # Píxeles cuya diferencia con el frame anterior (y con el siguiente, en three_frame) supera el umbral
+        if three_frame:
+            motion_pixel_counts = _three_frame_motion_pixel_counts(gray_frames, threshold)
+        else:
+            motion_pixel_counts = _motion_pixel_counts(gray_frames, threshold)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"Pixeles valiosos por frame: {motion_pixel_counts.tolist()}")
+
+        # Detectar los frames con movimiento (el conteo i corresponde al frame i + 1 en ambos modos)
+        min_motion_pixels = min_motion_pixels / (scale * scale)
+        motion_indices = np.flatnonzero(motion_pixel_counts > min_motion_pixels)
+        if min_blob_area is not None:
+            min_blob_area = min_blob_area / (scale * scale)
+            motion_indices = [i for i in motion_indices
+                              if self._largest_motion_blob(gray_frames[i], gray_frames[i + 1], threshold,
+                                                           gray_frames[i + 2] if three_frame else None) > min_blob_area]
+        return [i + 1 for i in motion_indices]
+
+    def background_subtraction(self, frames, min_motion_pixels=1500, scale=4, learning_rate=-1):
+        """
+        Alternativa a frame_differencing con el sustractor de fondo MOG2 de OpenCV. A diferencia de la
+        diferencia entre frames consecutivos, el modelo de fondo se mantiene entre fragmentos: los cambios
+        lentos (luz, sombras) se absorben en el fondo y los objetos que se mueven despacio no se pierden.
+        Si OpenCL está disponible y activado (cv2.ocl.useOpenCL()), los frames se procesan como cv2.UMat.
+
+        ### Parámetros:
+        - frames: List[numpy.ndarray]
+            Frames BGR (H, W, 3) o de un solo canal (H, W), como en frame_differencing.
+        - min_motion_pixels: int, opcional
+            Número mínimo de píxeles de primer plano (a resolución completa) para considerar que hay
+            movimiento. Default es 1500.
+        - scale: int, opcional
+            Factor de reducción lineal antes de aplicar el modelo, como en frame_differencing. Default es 4.
+        - learning_rate: float, opcional
+            Velocidad de actualización del fondo (0 a 1); -1 deja que MOG2 la elija según su historia.
+            Default es -1.
+
+        ### Retorno:
+        - motion_frames: List[numpy.ndarray]
+            Frames (a resolución completa) donde se detectó movimiento.
+        """
+        motion_indices = self.background_subtraction_indices(frames, min_motion_pixels, scale, learning_rate)
+        return [frames[i] for i in motion_indices]
+
+    def background_subtraction_indices(self, frames, min_motion_pixels=1500, scale=4, learning_rate=-1):
+        """
+        Igual que background_subtraction, pero devuelve los índices (en frames) de los frames con movimiento.
+        """
+        if self._background_subtractor is None:
+            # Sin detección de sombras: la máscara solo tiene fondo (0) y primer plano (255)
+            self._background_subtractor = cv2.createBackgroundSubtractorMOG2(detectShadows=False)
+        use_opencl = cv2.ocl.useOpenCL()
+
+        min_motion_pixels = min_motion_pixels / (scale * scale)
+        motion_indices = []
+        for i, frame in enumerate(frames):
+            small_gray = self._to_small_gray(frame, scale)
+            mask = self._background_subtractor.apply(cv2.UMat(small_gray) if use_opencl else small_gray,
+                                                     learningRate=learning_rate)
+            if cv2.countNonZero(mask) > min_motion_pixels:
+                motion_indices.append(i)
+        return motion_indices
+
+    def _largest_motion_blob(self, prev_gray, gray, threshold, next_gray=None):
+        """
+        Devuelve el área (en píxeles) de la mayor región conexa de la máscara de movimiento entre dos frames
+        (o, si se indica next_gray, de la máscara de tres frames).
+        """
+        _, mask = cv2.threshold(cv2.absdiff(gray, prev_gray), threshold, 255, cv2.THRESH_BINARY)
+        if next_gray is not None:
+            _, next_mask = cv2.threshold(cv2.absdiff(next_gray, gray), threshold, 255, cv2.THRESH_BINARY)
+            mask = cv2.bitwise_and(mask, next_mask)
+        num_labels, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        if num_labels < 2:  # Solo el fondo
+            return 0
+        return stats[1:, cv2.CC_STAT_AREA].max()
+
+    def _to_small_gray(self, frame, scale):
+        """
+        Reduce un frame scale veces por lado (INTER_AREA promedia los píxeles, lo que además filtra
+        el ruido del sensor) y lo convierte a escala de grises si es BGR.
+        """
+        if scale > 1:
+            frame = cv2.resize(frame, (frame.shape[1] // scale, frame.shape[0] // scale),
+                               interpolation=cv2.INTER_AREA)
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self._mask is not None:
+            # Las zonas ignoradas quedan a 0 en todos los frames, así su diferencia es siempre 0
+            gray = cv2.bitwise_and(gray, self._scaled_mask(gray.shape))
+        return gray
+
+    def _scaled_mask(self, shape):
+        """
+        Devuelve la máscara de movimiento al tamaño (alto, ancho) indicado, reescalándola solo la primera vez.
         """
-        prev_frame = None
-        motion_frames = []
-
-        for idx, frame in enumerate(frames):
-            # Convertir el frame a escala de grises
-            frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            if prev_frame is not None:
-                # Calcular diferencia entre el frame actual y el anterior
-                diff = cv2.absdiff(prev_frame, frame_gray)
-                
-                # Umbralización
-                _, diff_thresh = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
-
-                # # Dilatar para ampliar las áreas detectadas
-                # diff_thresh = cv2.dilate(diff_thresh, None, iterations=2)
-
-                # Contar píxeles de movimiento
-                non_zero_count = cv2.countNonZero(diff_thresh)
-                log.info(f"Frame {idx} con pixeles valiosos {non_zero_count}")
-                # Detectar si hay movimiento
-                if non_zero_count > min_motion_pixels:
-                    motion_frames.append(frame)
-
-            # Actualizar el frame anterior
-            prev_frame = frame_gray
-
-        return motion_frames
+        mask = self._scaled_masks.get(shape)
+        if mask is None:
+            mask = cv2.resize(self._mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+            self._scaled_masks[shape] = mask
+        return mask
@@ -1,30 +1,86 @@
+import time
 import boto3
 import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+from boto3.dynamodb.conditions import Key
+
+# orjson es opcional: serializa directamente a bytes y mucho más rápido; sin él se usa json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Init the logger.
+log = logging.getLogger(__name__)
 
 API_GATEWAY_ENDPOINT = f"https://uhqyaqtrqh.execute-api.eu-west-1.amazonaws.com/production"
+# Envíos concurrentes a API Gateway (uno por conexión) y conexiones HTTP del pool del cliente.
+# Keep-alive para reutilizar las conexiones TLS entre mensajes, timeouts cortos y reintentos acotados:
+# un mensaje de un fragmento que llega tarde ya no sirve al frontend.
+SEND_MAX_WORKERS = 32
+APIGW_CLIENT_CONFIG = Config(max_pool_connections=64,
+                             retries={'mode': 'adaptive', 'total_max_attempts': 3},
+                             tcp_keepalive=True,
+                             connect_timeout=2,
+                             read_timeout=5)
 DYNAMODB_TABLE_NAME = "c-IrisWebSocket"
-# Inicializar el cliente de DynamoDB
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+# GSI de la tabla con partition key stream_name
+DYNAMODB_STREAM_INDEX_NAME = "stream_name-index"
+# Segundos que se reutiliza la lista de conexiones de un stream antes de volver a consultar DynamoDB
+CONNECTION_IDS_CACHE_TTL = 5
+# Tabla de DynamoDB, se crea en la primera consulta (ver _get_table) y no al importar el módulo
+_table = None
+_table_lock = threading.Lock()
+
+# Pool compartido para los envíos, sus hilos se crean una vez y se reutilizan en cada mensaje
+_send_pool = ThreadPoolExecutor(max_workers=SEND_MAX_WORKERS)
+
+# Caché de conexiones por stream: stream_name -> (instante de la consulta, connection_ids)
+_conn_cache = {}
+_conn_cache_lock = threading.Lock()
 
 ####################################################
 # ApiGateway WebSocket
 
 def client_ag_manegement_api():
-    return boto3.client('apigatewaymanagementapi', endpoint_url=API_GATEWAY_ENDPOINT)
+    return boto3.client('apigatewaymanagementapi', endpoint_url=API_GATEWAY_ENDPOINT, config=APIGW_CLIENT_CONFIG)
+
+
+def _dumps(message):
+    """
+    Serializa el mensaje a bytes JSON, con orjson si está instalado (acepta también escalares y arrays de numpy).
+    """
+    if orjson is not None:
+        return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(message).encode()
+
+
+def _send_to_connection(apigw_client, connection_id, payload):
+    try:
+        apigw_client.post_to_connection(
+            ConnectionId=connection_id,
+            Data=payload
+        )
+    except apigw_client.exceptions.GoneException:
+        log.info('La conexión %s ya no existe.', connection_id)
+        _forget_connection(connection_id)
+    except Exception as e:
+        log.error('Error enviando mensaje a %s: %s', connection_id, e)
 
 
 def send_message_to_clients(apigw_client, active_connections, message):
-    for connection_id in active_connections:
-        try:
-            apigw_client.post_to_connection(
-                ConnectionId=connection_id,
-                Data=json.dumps(message)
-            )
-        except apigw_client.exceptions.GoneException:
-            print(f"La conexión {connection_id} ya no existe.")
-        except Exception as e:
-            print(f"Error enviando mensaje a {connection_id}: {e}")
+    if not active_connections:
+        return
+
+    # El mensaje se serializa una sola vez y se envía a todas las conexiones en paralelo; se espera a que
+    # terminen todos los envíos para que los mensajes de un stream no se adelanten entre sí
+    payload = _dumps(message)
+    futures = [_send_pool.submit(_send_to_connection, apigw_client, connection_id, payload)
+               for connection_id in active_connections]
+    wait(futures)
 
 ####################################################
 # DynamoDb
@@ -32,12 +88,60 @@ def send_message_to_clients(apigw_client, active_connections, message):
 def get_connection_ids_by_stream(stream_name):
     """
     Obtiene todos los connectionId asociados a un stream_name específico.
+    La lista se cachea CONNECTION_IDS_CACHE_TTL segundos: las conexiones de un stream en vivo
+    cambian poco y así no se consulta DynamoDB en cada envío.
     """
-    response = table.scan(
-        FilterExpression="stream_name = :stream_name",
-        ExpressionAttributeValues={":stream_name": stream_name}
-    )
-    
+    now = time.monotonic()
+    with _conn_cache_lock:
+        cached = _conn_cache.get(stream_name)
+        if cached is not None and now - cached[0] < CONNECTION_IDS_CACHE_TTL:
+            return list(cached[1])
+
+    connection_ids = _query_connection_ids(stream_name)
+    with _conn_cache_lock:
+        _conn_cache[stream_name] = (now, connection_ids)
+    return list(connection_ids)
+
+
+def _forget_connection(connection_id):
+    """
+    Quita de la caché una conexión que API Gateway reporta como cerrada (GoneException).
+    """
+    with _conn_cache_lock:
+        for _, connection_ids in _conn_cache.values():
+            if connection_id in connection_ids:
+                connection_ids.remove(connection_id)
+
+
+def _get_table():
+    """
+    Devuelve la tabla de conexiones, creando el recurso de DynamoDB la primera vez que se usa.
+    Así importar el módulo no carga el modelo de DynamoDB ni resuelve credenciales.
+    """
+    global _table
+    with _table_lock:
+        if _table is None:
+            _table = boto3.resource('dynamodb').Table(DYNAMODB_TABLE_NAME)
+        return _table
+
+
+def _query_connection_ids(stream_name):
+    """
+    Consulta el GSI de stream_name (solo lee los items del stream, no la tabla entera)
+    y pagina con LastEvaluatedKey.
+    """
+    query_kwargs = {
+        "IndexName": DYNAMODB_STREAM_INDEX_NAME,
+        "KeyConditionExpression": Key('stream_name').eq(stream_name),
+        "ProjectionExpression": "connection_id",
+    }
+
     # Extraer solo los connectionId
-    connection_ids = [item['connection_id'] for item in response.get('Items', [])]
-    return connection_ids
\ No newline at end of file
+    table = _get_table()
+    connection_ids = []
+    while True:
+        response = table.query(**query_kwargs)
+        connection_ids.extend(item['connection_id'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return connection_ids
+        query_kwargs["ExclusiveStartKey"] = response['LastEvaluatedKey']
@@ -4,23 +4,115 @@ import json
 import time
 import boto3
 import cv2
+import numpy as np
 import io
+import hashlib
+import queue
+import signal
+import atexit
 import logging
-from collections import defaultdict
+import logging.handlers
+from threading import Thread, Event, Lock
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 from amazon_websocket_apigateway import websocket_apigateway as websocket_ag
 from amazon_kinesis_video_consumer_library.motion_detector import MotionDetector
 from amazon_kinesis_video_consumer_library.kinesis_video_streams_parser import KvsParser
 from amazon_kinesis_video_consumer_library.kinesis_video_fragment_processor import KvsFragementProcessor
 
-# Config the logger.
+# Config the logger. Records go through a queue and are written to stdout by a QueueListener thread,
+# so the KvsParser and worker threads never block on log I/O.
 log = logging.getLogger(__name__)
-logging.basicConfig(format="[%(name)s.%(funcName)s():%(lineno)d] - [%(levelname)s] - %(message)s", 
-                    stream=sys.stdout, 
+_log_queue = queue.SimpleQueue()
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(logging.Formatter("[%(name)s.%(funcName)s():%(lineno)d] - [%(levelname)s] - %(message)s"))
+logging.basicConfig(handlers=[logging.handlers.QueueHandler(_log_queue)],
+                    format="%(message)s",  # The QueueHandler only renders the message, _stdout_handler adds the rest
                     level=logging.INFO)
+# The listener starts together with the QueueHandler, so records are written however the module is loaded,
+# and atexit stops it to flush the records still queued.
+_log_listener = logging.handlers.QueueListener(_log_queue, _stdout_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# OpenCV runs single threaded per call: frame level work is already parallel (JPEG encode/write pools,
+# Numba motion kernel), and letting every cv2 call also fan out over all cores oversubscribes the CPU.
+cv2.setUseOptimized(True)
+cv2.setNumThreads(1)
 
 # Update the desired region and KVS stream name.
 STREAM_NAME = os.getenv("STREAM_NAME", "Rancho_1")
 
+# KVS control plane (GetDataEndpoint) and media (GetMedia) clients: keepalive so a GetMedia restart reuses
+# the warm connection, adaptive retries for throttling. The media client keeps botocore's default read
+# timeout, a live GetMedia stream can go quiet for seconds between fragments.
+KVS_CLIENT_CONFIG = Config(retries={'mode': 'adaptive', 'max_attempts': 10},
+                           tcp_keepalive=True)
+
+# Concurrent Rekognition detect_labels calls per fragment. The client's HTTP pool is sized above it,
+# connections are kept alive between fragments and a stuck call fails fast instead of stalling the worker.
+REKOGNITION_MAX_WORKERS = 16
+REKOGNITION_CLIENT_CONFIG = Config(max_pool_connections=32,
+                                   retries={'mode': 'adaptive', 'total_max_attempts': 3},
+                                   tcp_keepalive=True,
+                                   connect_timeout=2,
+                                   read_timeout=5)
+
+# Longest side (pixels) of the JPEGs uploaded to Rekognition, larger frames are downscaled.
+REKOGNITION_MAX_EDGE = 1280
+# Motion frames whose 64 bit dHash is within this Hamming distance of a frame already sent for the same
+# fragment show the same scene and are not sent to Rekognition again.
+REKOGNITION_DHASH_DISTANCE = 6
+# Rekognition responses kept by JPEG content hash, a byte-identical image is never sent twice.
+REKOGNITION_CACHE_SIZE = 256
+# Decimals kept in the normalized bounding box coordinates sent to the websocket (1e-4 is well under a pixel at 1080p).
+BOUNDING_BOX_DECIMALS = 4
+
+# Linear downscale applied to the frames before motion differencing (16x fewer pixels compared).
+# Detected motion frames are still returned at full resolution for Rekognition.
+MOTION_DOWNSCALE = 4
+
+# Minimum number of changed pixels (full resolution) for a frame to count as motion.
+MOTION_MIN_PIXELS = 1500
+
+# Minimum area (full resolution pixels) of a connected motion region for a frame to be sent to Rekognition.
+# Scattered changes (flickering LEDs, leaf shadows) don't form a region this big and skip the Rekognition call.
+MOTION_MIN_BLOB_AREA = 2000
+
+# Optional grayscale image (white: watch, black: ignore) masking out regions that move but aren't of interest.
+MOTION_MASK_PATH = os.getenv("MOTION_MASK_PATH")
+
+# Opt-in three-frame differencing: a frame only counts as motion if it differs from both its neighbours,
+# which drops lasting changes (light switched on, shadows) at the cost of not evaluating the last frame.
+MOTION_THREE_FRAME = os.getenv("MOTION_THREE_FRAME", "false").lower() == "true"
+
+# Opt-in MOG2 background subtraction instead of frame differencing. The background model persists across
+# fragments, so it has to learn the scene for a few fragments after start before it stops reporting motion.
+MOTION_BACKGROUND_SUBTRACTOR = os.getenv("MOTION_BACKGROUND_SUBTRACTOR", "false").lower() == "true"
+
+# Seconds between the main loop health logs while the stream is being read.
+HEALTH_LOG_INTERVAL = 60
+
+# Opt-in coarse gate: compare each fragment's keyframe with the previous one's and skip the full decode,
+# motion detection and Rekognition when the scene hasn't changed. Motion that starts and ends between two
+# keyframes is missed, so it's off by default.
+KEYFRAME_MOTION_GATE = os.getenv("KEYFRAME_MOTION_GATE", "false").lower() == "true"
+# Mean absolute gray level difference between keyframes above which the fragment is fully processed.
+KEYFRAME_GATE_THRESHOLD = 2.0
+
+# Fragments waiting to be processed. When processing falls behind the oldest fragment is dropped.
+FRAGMENT_QUEUE_SIZE = 4
+# Fragments with motion waiting for Rekognition, dropped oldest first the same way.
+LABEL_QUEUE_SIZE = 2
+# Websocket messages waiting to be sent. A late fragment's boxes are useless to the frontend, so when API
+# Gateway is slow the oldest message is dropped too.
+WEBSOCKET_QUEUE_SIZE = 8
+
+# Bytes read from the GetMedia stream per KvsParser iteration: 16 KiB reads parse the buffered fragment 16x less
+# often than the default 1 KiB, while a read waits at most ~60 ms for data on a 2 Mbps stream.
+KVS_READ_CHUNK_SIZE = 16 * 1024
+
 class KvsPythonConsumer:
     '''
     Example class to demonstrate usage the AWS Kinesis Video Streams KVS) Consumer Library for Python.
@@ -48,13 +140,52 @@ class KvsPythonConsumer:
         # Init the KVS Service Client and get the accounts KVS service endpoint
         log.info('Initializing Amazon Kinesis Video client....')
         self.session = boto3.Session()
-        self.kvs_client = self.session.client("kinesisvideo")
-        self.rekognition_client = self.session.client("rekognition")
-        self.motion_detector = MotionDetector()
+        self.kvs_client = self.session.client("kinesisvideo", config=KVS_CLIENT_CONFIG)
+        self.rekognition_client = self.session.client("rekognition", config=REKOGNITION_CLIENT_CONFIG)
+        # One pool for the detect_labels calls of every fragment, its threads share the client's warm connections
+        self._rekognition_pool = ThreadPoolExecutor(max_workers=REKOGNITION_MAX_WORKERS)
+
+        # LRU of Rekognition responses by JPEG hash, shared by the get_labels_from_frames workers
+        self._labels_cache = OrderedDict()
+        self._labels_cache_lock = Lock()
+
+        # KVS data endpoints per (stream, API) and media clients per endpoint, reused if service_loop restarts a stream
+        self._data_endpoints = {}
+        self._media_clients = {}
+        self.motion_detector = MotionDetector(mask_path=MOTION_MASK_PATH)
+
+        # Resolve the GetMedia endpoint and build its media client up front so service_loop goes straight to GetMedia
+        log.info('Getting KVS GetMedia Endpoint for stream: %s ........', STREAM_NAME)
+        self.kvs_media_client = self._get_media_client(self._get_data_endpoint(STREAM_NAME, 'GET_MEDIA'))
 
         # Thumbnail
         self.thumbnail_taked = False
 
+        # Downscaled gray keyframe of the previous fragment for the KEYFRAME_MOTION_GATE
+        self._prev_keyframe = None
+
+        # Background pool for uploads/writes so disk and S3 latency never stall the fragment worker
+        self._io_pool = ThreadPoolExecutor(max_workers=2)
+
+        # Set by the KvsParser completion/exception callbacks or by SIGINT/SIGTERM, the main loop sleeps on it.
+        self._shutdown = Event()
+
+        # Fragments are processed on a worker thread so the KvsParser thread only reads the stream
+        self._work_q = queue.Queue(maxsize=FRAGMENT_QUEUE_SIZE)
+        self._worker_thread = Thread(target=self._process_fragments_worker, daemon=True)
+        self._worker_thread.start()
+
+        # Motion frames are labelled on a second worker: while fragment N waits on Rekognition,
+        # fragment N + 1 is already being decoded and diffed by the fragment worker.
+        self._label_q = queue.Queue(maxsize=LABEL_QUEUE_SIZE)
+        self._label_thread = Thread(target=self._label_motion_frames_worker, daemon=True)
+        self._label_thread.start()
+
+        # Websocket messages are sent from their own thread so the next fragment's processing overlaps the sends
+        self._ws_queue = queue.Queue(maxsize=WEBSOCKET_QUEUE_SIZE)
+        self._ws_sender_thread = Thread(target=self._websocket_sender, daemon=True)
+        self._ws_sender_thread.start()
+
 
     ####################################################
     # Main process loop
@@ -63,30 +194,18 @@ class KvsPythonConsumer:
         ####################################################
         # Start an instance of the KvsParser reading in a Kinesis Video Stream
 
-        # Get the KVS Endpoint for the GetMedia Call for this stream
-        log.info(f'Getting KVS GetMedia Endpoint for stream: {STREAM_NAME} ........')
-        get_media_endpoint = self._get_data_endpoint(STREAM_NAME, 'GET_MEDIA')
-        
-        # Get the KVS Media client for the GetMedia API call
-        log.info(f'Initializing KVS Media client for stream: {STREAM_NAME}........')
-        kvs_media_client = self.session.client('kinesis-video-media', endpoint_url=get_media_endpoint)
-
         # Make a KVS GetMedia API call with the desired KVS stream and StartSelector type and time bounding.
-        log.info(f'Requesting KVS GetMedia Response for stream: {STREAM_NAME}........')
-        get_media_response = kvs_media_client.get_media(
-            StreamName=STREAM_NAME,
-            StartSelector={
-                'StartSelectorType': 'NOW'
-            }
-        )
+        log.info('Requesting KVS GetMedia Response for stream: %s........', STREAM_NAME)
+        get_media_response = self._get_media(STREAM_NAME, {'StartSelectorType': 'NOW'})
 
         # Initialize an instance of the KvsParser, provide the GetMedia response and the required call-backs
-        log.info(f'Starting KvsParser for stream: {STREAM_NAME}........')
+        log.info('Starting KvsParser for stream: %s........', STREAM_NAME)
         my_stream01_consumer = KvsParser(STREAM_NAME, 
                                               get_media_response, 
                                               self.on_fragment_arrived, 
                                               self.on_stream_read_complete, 
-                                              self.on_stream_read_exception
+                                              self.on_stream_read_exception,
+                                              chunk_size=KVS_READ_CHUNK_SIZE
                                             )
 
         # Start the instance of KvsParser, any matching fragments will begin arriving in the on_fragment_arrived callback
@@ -101,13 +220,15 @@ class KvsPythonConsumer:
     
         # Run a loop with the applications main functionality that holds the process open.
         # Can also use to monitor the completion of the KvsParser instance and trigger a required action on completion.
-        while True:
-            log.info("Main application loop running...")
-            time.sleep(5)
-            
-            
-            # Call below to exit the streaming get_media() thread gracefully before reaching end of stream. 
-            #my_stream01_consumer.stop_thread()
+        # The loop sleeps on the shutdown event, so SIGINT/SIGTERM or the end of the stream unblock it immediately.
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self._shutdown.set())
+        while not self._shutdown.wait(timeout=HEALTH_LOG_INTERVAL):
+            log.debug("Main application loop running...")
+
+        # Exit the streaming get_media() thread gracefully if we stopped before reaching end of stream.
+        my_stream01_consumer.stop_thread()
+        log.info('Exiting main application loop for stream: %s', STREAM_NAME)
 
 
     ####################################################
@@ -144,42 +265,82 @@ class KvsPythonConsumer:
         try:
             # Log the arrival of a fragment. 
             # use stream_name to identify fragments where multiple instances of the KvsParser are running on different streams.
-            start_time = time.time() 
-            log.info(f'\n\n##########################\nFragment Received on Stream: {stream_name}\nProcessing Duration: {fragment_receive_duration} Secs\n##########################')
-            self.last_good_fragment_tags = self.kvs_fragment_processor.get_fragment_tags(fragment_dom)
+            start_time = time.perf_counter()
+            log.info('Fragment received on stream: %s recv=%.3fs', stream_name, fragment_receive_duration)
+            # Tags are read straight from the fragment bytes, jumping over the Clusters instead of walking the DOM.
+            self.last_good_fragment_tags = self.kvs_fragment_processor.scan_tags_fast(fragment_bytes)
 
             # Using the fragment number as a key/name for the frames
             fragment_number = self.last_good_fragment_tags['AWS_KINESISVIDEO_FRAGMENT_NUMBER']
             
             producer_timestamp = self.last_good_fragment_tags['AWS_KINESISVIDEO_PRODUCER_TIMESTAMP']
             
-            motion_frames = self.process_fragment_frames(fragment_bytes, producer_timestamp, fragment_number)
-            print(f"Resultado del procesamiento: {'Movimiento Detectado' if len(motion_frames) > 0 else '[]'}")
-            processing_duration = time.time() - start_time
-            print(f"Callback completado en {processing_duration:.4f} segundos.")
+            # Hand the fragment to the worker thread, motion detection and Rekognition run there.
+            self._put_drop_oldest(self._work_q, (fragment_bytes, producer_timestamp, fragment_number, start_time))
 
         except Exception as err:
-            log.error(f'on_fragment_arrived Error: {err}')
+            log.error('on_fragment_arrived Error: %s', err)
+
+    def _put_drop_oldest(self, work_q, work_item):
+        '''
+        Puts a work item (a tuple with the fragment number as its third field, or a websocket message dict)
+        on a bounded pipeline queue without blocking the producing thread. If the queue is full the oldest pending item is dropped:
+        for live motion alerts the newest fragment is the one worth processing.
+        '''
+        while True:
+            try:
+                work_q.put_nowait(work_item)
+                return
+            except queue.Full:
+                try:
+                    dropped = work_q.get_nowait()
+                    dropped_fragment = dropped["fragment_number"] if isinstance(dropped, dict) else dropped[2]
+                    log.warning('Processing is falling behind, dropping fragment: %s', dropped_fragment)
+                except queue.Empty:
+                    pass
+
+    def _process_fragments_worker(self):
+        '''
+        Worker thread loop: takes fragments from the work queue and runs process_fragment_frames on them.
+        '''
+        while True:
+            fragment_bytes, producer_timestamp, fragment_number, start_time = self._work_q.get()
+            try:
+                motion_frames = self.process_fragment_frames(fragment_bytes, producer_timestamp, fragment_number)
+                log.info('Resultado del procesamiento: %s', 'Movimiento Detectado' if motion_frames else '[]')
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('Callback completado en %.1f ms.', (time.perf_counter() - start_time) * 1000)
+            except Exception as err:
+                log.error('Fragment processing Error: %s', err)
+
+    def _label_motion_frames_worker(self):
+        '''
+        Worker thread loop: takes the motion frames of a fragment from the label queue and runs label_motion_frames on them.
+        '''
+        while True:
+            motion_frames, producer_timestamp, fragment_number, start_time = self._label_q.get()
+            try:
+                self.label_motion_frames(motion_frames, producer_timestamp, fragment_number, start_time)
+            except Exception as err:
+                log.error('Fragment labelling Error: %s', err)
 
     def process_fragment_frames(self, fragment_bytes, producer_timestamp, fragment_number):
         '''
         Processes the fragment frames for motion detection and object recognition.
 
-        This function extracts frames from the fragment, detects motion, and identifies objects using AWS Rekognition.
+        This function extracts frames from the fragment and detects motion. Frames with motion are handed to the
+        label worker, which identifies objects using AWS Rekognition (see label_motion_frames).
 
         ### Parameters:
 
             **fragment_bytes**: bytearray
                 Raw bytes of the fragment to process.
 
-            **frames_path**: str
-                Path to save the extracted frames as images.
-
-            **labels_path**: str
-                Path to save the labels detected by AWS Rekognition.
+            **producer_timestamp**: str
+                Producer timestamp tag of the fragment.
 
-            **detections_path**: str
-                Path to save the frames with bounding boxes of detected objects.
+            **fragment_number**: str
+                Fragment number tag of the fragment.
 
         ### Returns:
 
@@ -187,40 +348,116 @@ class KvsPythonConsumer:
                 List of frames where motion was detected.
         '''
         try:
-            start_time = time.time()
-            # Obtains the frames of the fragment in a numpy array type
-            frames = self.kvs_fragment_processor.get_frames_as_ndarray(fragment_bytes, one_in_frames_ratio=5)
+            start_time = time.perf_counter()
+            if KEYFRAME_MOTION_GATE and not self._keyframe_changed(fragment_bytes):
+                return []
+
+            # Decodes the fragment once: motion detection runs on small grayscale frames and only the
+            # frames with motion (plus the thumbnail) are converted to full resolution RGB numpy arrays.
+            gray_frames, video_frames = self.kvs_fragment_processor.get_motion_frames_as_ndarray(
+                fragment_bytes, one_in_frames_ratio=5, scale=MOTION_DOWNSCALE)
+            if not video_frames:
+                return []
 
             if not self.thumbnail_taked:
-                print("Taking thumbnail")
-                first_frame = frames[0]
+                log.info('Taking thumbnail')
+                first_frame = video_frames[0].to_ndarray(format="rgb24")
                 self.take_thumbnail(first_frame)
                 self.thumbnail_taked = True
 
-            # Detects which frames of the fragment have motion
-            motion_frames = self.motion_detector.frame_differencing(frames)
+            # Detects which frames of the fragment have motion. The gray frames are already downscaled,
+            # so the full resolution pixel thresholds are scaled down here.
+            scaled_area = MOTION_DOWNSCALE * MOTION_DOWNSCALE
+            if MOTION_BACKGROUND_SUBTRACTOR:
+                motion_indices = self.motion_detector.background_subtraction_indices(
+                    gray_frames, min_motion_pixels=MOTION_MIN_PIXELS / scaled_area, scale=1)
+            else:
+                motion_indices = self.motion_detector.frame_differencing_indices(
+                    gray_frames, min_motion_pixels=MOTION_MIN_PIXELS / scaled_area, scale=1,
+                    min_blob_area=MOTION_MIN_BLOB_AREA / scaled_area, three_frame=MOTION_THREE_FRAME)
+            motion_frames = [video_frames[i].to_ndarray(format="rgb24") for i in motion_indices]
             if len(motion_frames) > 0 :
-                # Gets the AWS Rekognition response with the labels
-                labels_fragment = self.get_labels_from_frames(motion_frames)
-                # Parse the Rekognition Response
-                # fragment_bounding_boxes, fragment_unique_bboxs = self.get_bounding_boxes(labels_fragment)
-                fragment_bounding_boxes = self.get_bounding_boxes(labels_fragment)
-                
-                # Enviar bounding boxes al frontend mediante AWS
-                active_connections = websocket_ag.get_connection_ids_by_stream(STREAM_NAME)
-                websocket_ag.send_message_to_clients(self.apigw_client, active_connections, {
-                    "fragment_number": fragment_number,
-                    "timestamp": producer_timestamp,
-                    "labels": fragment_bounding_boxes
-                })
-                processing_duration = time.time() - start_time
-                print(f"Procesamiento de movimiento completado en {processing_duration:.4f} segundos.")
+                # Rekognition runs on the label worker, this worker moves on to the next fragment
+                self._put_drop_oldest(self._label_q, (motion_frames, producer_timestamp, fragment_number, start_time))
             
             return motion_frames
 
         except Exception as e:
-            print(f"Error en el procesamiento del fragmento: {e}")
+            log.error('Error en el procesamiento del fragmento: %s', e)
+
+    def label_motion_frames(self, motion_frames, producer_timestamp, fragment_number, start_time):
+        '''
+        Identifies objects in the motion frames of a fragment using AWS Rekognition and queues the
+        bounding boxes for the websocket clients.
+
+        ### Parameters:
+
+            **motion_frames**: list
+                Frames of the fragment where motion was detected.
+
+            **producer_timestamp**: str
+                Producer timestamp tag of the fragment.
+
+            **fragment_number**: str
+                Fragment number tag of the fragment.
+
+            **start_time**: float
+                time.perf_counter() when the processing of the fragment started.
+        '''
+        # Gets the AWS Rekognition response with the labels
+        labels_fragment = self.get_labels_from_frames(motion_frames)
+        # Parse the Rekognition Response
+        fragment_bounding_boxes = self.get_bounding_boxes(labels_fragment)
+
+        # Enviar bounding boxes al frontend mediante AWS (desde el hilo de websocket)
+        self._put_drop_oldest(self._ws_queue, {
+            "fragment_number": fragment_number,
+            "timestamp": producer_timestamp,
+            "labels": fragment_bounding_boxes
+        })
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Procesamiento de movimiento completado en %.1f ms.', (time.perf_counter() - start_time) * 1000)
             
+    def _keyframe_changed(self, fragment_bytes):
+        '''
+        Decodes only the fragment's keyframe and compares it, downscaled to gray, with the previous fragment's.
+
+        ### Returns:
+            **changed**: bool
+                True if the scene changed (or there's no previous keyframe to compare with).
+        '''
+        keyframe = self.kvs_fragment_processor.get_keyframe_as_ndarray(fragment_bytes)
+        if keyframe is None:
+            return True
+        height, width = keyframe.shape[:2]
+        small = cv2.resize(keyframe, (width // 8, height // 8), interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+
+        prev_keyframe, self._prev_keyframe = self._prev_keyframe, small
+        if prev_keyframe is None or prev_keyframe.shape != small.shape:
+            return True
+        return cv2.absdiff(prev_keyframe, small).mean() > KEYFRAME_GATE_THRESHOLD
+
+    def _websocket_sender(self):
+        '''
+        Websocket sender thread loop. Drains every message queued since the last pass and sends them in
+        order, looking up the stream's active connections once per pass instead of once per message.
+        '''
+        while True:
+            messages = [self._ws_queue.get()]
+            while True:
+                try:
+                    messages.append(self._ws_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                active_connections = websocket_ag.get_connection_ids_by_stream(STREAM_NAME)
+                for message in messages:
+                    websocket_ag.send_message_to_clients(self.apigw_client, active_connections, message)
+            except Exception as err:
+                log.error('Websocket send Error: %s', err)
+
     def get_labels_from_frames(self, frames):
         '''
         Extracts labels from frames using AWS Rekognition, saves the Rekognition response for each frame as a JSON file,
@@ -238,19 +475,67 @@ class KvsPythonConsumer:
                 A list of labels detected by Rekognition for each frame.
         '''
         labels = []
+        # Near-identical frames would return the same labels, only one of them is sent.
+        frames = self._distinct_frames(frames)
         # Convert frames to JPEG format using the processor utility.
-        frames_jpeg = self.kvs_fragment_processor.get_ndarray_frames_to_jpeg(frames)
-        for idx, jpeg in enumerate(frames_jpeg):
-            # Call AWS Rekognition to detect labels in the JPEG image.
-            response = self.rekognition_client.detect_labels(
-                Image={'Bytes': jpeg},
-                MaxLabels=10,
-                MinConfidence=80
-            )
+        # Frames are downscaled before encoding: bounding boxes are normalized so they don't change.
+        frames_jpeg = self.kvs_fragment_processor.get_ndarray_frames_to_jpeg(frames, max_edge=REKOGNITION_MAX_EDGE)
+        if not frames_jpeg:
+            return labels
+
+        # Call AWS Rekognition for all the JPEG images concurrently, responses come back in frame order.
+        for response in self._rekognition_pool.map(self._detect_labels, frames_jpeg):
             # Append detected labels to the result list.
             labels += response["Labels"]
         return labels
 
+    def _distinct_frames(self, frames):
+        '''
+        Drops the frames that are perceptually the same as an earlier frame of the list, comparing
+        64 bit difference hashes (dHash) with a Hamming distance up to REKOGNITION_DHASH_DISTANCE.
+        '''
+        distinct_frames = []
+        seen_hashes = []
+        for frame in frames:
+            frame_hash = self._dhash(frame)
+            if all((frame_hash ^ seen_hash).bit_count() > REKOGNITION_DHASH_DISTANCE for seen_hash in seen_hashes):
+                seen_hashes.append(frame_hash)
+                distinct_frames.append(frame)
+        return distinct_frames
+
+    def _dhash(self, frame):
+        '''
+        64 bit difference hash of an RGB frame: 9x8 gray thumbnail, one bit per horizontally adjacent pixel pair.
+        '''
+        small = cv2.cvtColor(cv2.resize(frame, (9, 8), interpolation=cv2.INTER_AREA), cv2.COLOR_RGB2GRAY)
+        return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+    def _detect_labels(self, jpeg):
+        '''
+        Calls AWS Rekognition to detect labels in one JPEG image. The boto3 client is thread-safe
+        so it's shared by all the get_labels_from_frames workers.
+
+        Responses are cached by a 64 bit BLAKE2b hash of the JPEG bytes (REKOGNITION_CACHE_SIZE entries,
+        least recently used evicted), so a repeated image skips the network round trip.
+        '''
+        jpeg_hash = hashlib.blake2b(jpeg, digest_size=8).digest()
+        with self._labels_cache_lock:
+            response = self._labels_cache.get(jpeg_hash)
+            if response is not None:
+                self._labels_cache.move_to_end(jpeg_hash)
+                return response
+
+        response = self.rekognition_client.detect_labels(
+            Image={'Bytes': jpeg},
+            MaxLabels=10,
+            MinConfidence=80
+        )
+        with self._labels_cache_lock:
+            self._labels_cache[jpeg_hash] = response
+            if len(self._labels_cache) > REKOGNITION_CACHE_SIZE:
+                self._labels_cache.popitem(last=False)
+        return response
+
     def get_bounding_boxes(self, labels_fragment):
         '''
         Parses the Rekognition response to extract bounding boxes and corresponding metadata 
@@ -262,42 +547,37 @@ class KvsPythonConsumer:
                 A list containing Rekognition responses (labels and instances) for multiple frames.
 
         ### Returns:
-            **fragment_bounding_boxes**: list of list of dict
-                A list of bounding boxes for each frame. Each bounding box contains the label name, 
+            **fragment_bounding_boxes**: list of dict
+                A flat list of the deduplicated bounding boxes of the fragment. Each bounding box contains the label name, 
                 bounding box coordinates, and confidence score.
         '''
-        fragment_bounding_boxes_1 = []
-        fragment_bounding_boxes_2 = []
-        valid_fragment_labels = []
-        
-        # Filter out parent labels that have children with instances.
-        parents = set()
-        child_labels = []
-        for label in labels_fragment:
-            if len(label["Instances"]) > 0:
-                if label["Name"] not in parents:
-                    child_labels.append(label)
-                    # Add parent names to the set to identify child-parent relationships.
-                    for parent in label["Parents"]:
-                        parents.add(parent["Name"])
-        # Retain only the child labels without parents in the final list.
-        valid_fragment_labels += [label for label in child_labels if label["Name"] not in parents]
-        
+        # Filter out parent labels that have children with instances: one pass to collect the parent
+        # names of the labels with instances, one pass to keep the labels that aren't a parent.
+        # A label listed among its own parents doesn't count, or it would filter itself out.
+        labels_with_instances = [label for label in labels_fragment if label["Instances"]]
+        parents = {parent["Name"] for label in labels_with_instances for parent in label["Parents"]
+                   if parent["Name"] != label["Name"]}
+        valid_fragment_labels = [label for label in labels_with_instances if label["Name"] not in parents]
+
         # Extract bounding box information for valid labels.
-        frame_bounding_boxes = []
-        for label in valid_fragment_labels:
-            for instance in label["Instances"]:
-                frame_bounding_boxes.append(
-                    {
-                        "Name": label["Name"],
-                        "Bounding_box": instance["BoundingBox"],
-                        "Confidence": instance["Confidence"],
-                    }
-                )
-        fragment_bounding_boxes_1.append(frame_bounding_boxes)
-        print(fragment_bounding_boxes_1)
-        fragment_bounding_boxes_2 = self.deduplicate_detections(fragment_bounding_boxes_1)
-        return fragment_bounding_boxes_2
+        frame_bounding_boxes = [
+            {
+                "Name": label["Name"],
+                "Bounding_box": instance["BoundingBox"],
+                "Confidence": instance["Confidence"],
+            }
+            for label in valid_fragment_labels
+            for instance in label["Instances"]
+        ]
+        fragment_bounding_boxes = self.deduplicate_detections(frame_bounding_boxes)
+        # Coordinates are sent rounded, the full float precision Rekognition returns only makes the message longer.
+        # New dicts are built: the responses (and their BoundingBox dicts) are shared with the labels cache.
+        for detection in fragment_bounding_boxes:
+            detection["Bounding_box"] = {key: round(value, BOUNDING_BOX_DECIMALS)
+                                         for key, value in detection["Bounding_box"].items()}
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('fragment_bounding_boxes: %s', fragment_bounding_boxes)
+        return fragment_bounding_boxes
 
     def compute_iou(self, box1, box2):
         x1_min = box1['Left']
@@ -326,25 +606,24 @@ class KvsPythonConsumer:
         return inter_area / union_area
 
     def take_thumbnail(self, frame):
-        first_frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        success, encoded_image = cv2.imencode('.jpg', first_frame_bgr)
-        if not success:
-            raise ValueError("No se pudo codificar el frame como JPEG")
+        # Same JPEG encoder as the Rekognition frames: it takes the RGB frame as is, no BGR conversion copy.
+        image_bytes = io.BytesIO(self.kvs_fragment_processor.get_ndarray_frames_to_jpeg([frame])[0])
+        self._io_pool.submit(self._upload_thumbnail, image_bytes)
 
-        image_bytes = io.BytesIO(encoded_image.tobytes())
-        s3 = self.session.client("s3")
-        s3.upload_fileobj(image_bytes, "c-iris", f"thumbnails/{STREAM_NAME}/thumbnail.jpg")
+    def _upload_thumbnail(self, image_bytes):
+        try:
+            s3 = self.session.client("s3")
+            s3.upload_fileobj(image_bytes, "c-iris", f"thumbnails/{STREAM_NAME}/thumbnail.jpg")
+        except Exception as err:
+            log.error('Thumbnail upload Error: %s', err)
 
     # --- Deduplicar detecciones solapadas por tipo ---
-    def deduplicate_detections(self, detections_nested, iou_threshold=0.5):
+    def deduplicate_detections(self, detections, iou_threshold=0.5):
         result = []
         by_name = defaultdict(list)
 
-        # Aplanar la lista de listas
-        all_detections = [item for sublist in detections_nested for item in sublist]
-
         # Agrupar por 'Name'
-        for det in all_detections:
+        for det in detections:
             by_name[det['Name']].append(det)
 
         # Procesar cada grupo
@@ -375,8 +654,8 @@ class KvsPythonConsumer:
             **stream_name**: str
                 Name of the stream being read, useful when processing multiple streams.
         '''
-        print(f'Read Media on stream: {stream_name} Completed successfully - Last Fragment Tags: {self.last_good_fragment_tags}')
-        log.info(f'Read Media on stream: {stream_name} Completed successfully - Last Fragment Tags: {self.last_good_fragment_tags}')
+        log.info('Read Media on stream: %s Completed successfully - Last Fragment Tags: %s', stream_name, self.last_good_fragment_tags)
+        self._shutdown.set()
         # self.websocket_server.stop_server()
 
     def on_stream_read_exception(self, stream_name, error):
@@ -406,13 +685,16 @@ class KvsPythonConsumer:
         #}
 
         # Here we just log the error 
-        print(f'####### ERROR: Exception on read stream: {stream_name}\n####### Fragment Tags:\n{self.last_good_fragment_tags}\nError Message:{error}')
+        log.error('####### ERROR: Exception on read stream: %s\n####### Fragment Tags:\n%s\nError Message:%s',
+                  stream_name, self.last_good_fragment_tags, error)
+        self._shutdown.set()
         # self.websocket_server.stop_server()
 
     def _get_data_endpoint(self, stream_name, api_name):
         '''
         Retrieves the endpoint for a specific API call using the KVS client. 
         This endpoint is required for subsequent interactions with the KVS API.
+        Endpoints are stable for the lifetime of a stream so they're cached per stream and API.
 
         ### Parameters:
             **stream_name**: str
@@ -425,11 +707,49 @@ class KvsPythonConsumer:
             **data_endpoint**: str
                 The endpoint URL for the requested API.
         '''
-        response = self.kvs_client.get_data_endpoint(
-            StreamName=stream_name,
-            APIName=api_name
-        )
-        return response['DataEndpoint']
+        key = (stream_name, api_name)
+        if key not in self._data_endpoints:
+            response = self.kvs_client.get_data_endpoint(
+                StreamName=stream_name,
+                APIName=api_name
+            )
+            self._data_endpoints[key] = response['DataEndpoint']
+        return self._data_endpoints[key]
+
+    def _get_media(self, stream_name, start_selector):
+        '''
+        Calls KVS GetMedia with the media client resolved in __init__. If KVS rejects the endpoint
+        (InvalidEndpointException, e.g. after an endpoint rotation) the endpoint is resolved again
+        and the call retried once, the happy path makes no extra control plane calls.
+
+        ### Parameters:
+            **stream_name**: str
+                Name of the Kinesis Video Stream.
+
+            **start_selector**: dict
+                GetMedia StartSelector.
+        '''
+        try:
+            return self.kvs_media_client.get_media(StreamName=stream_name, StartSelector=start_selector)
+        except self.kvs_media_client.exceptions.InvalidEndpointException:
+            log.warning('GetMedia endpoint rejected for stream: %s, resolving it again', stream_name)
+            stale_endpoint = self._data_endpoints.pop((stream_name, 'GET_MEDIA'), None)
+            self._media_clients.pop(stale_endpoint, None)
+            self.kvs_media_client = self._get_media_client(self._get_data_endpoint(stream_name, 'GET_MEDIA'))
+            return self.kvs_media_client.get_media(StreamName=stream_name, StartSelector=start_selector)
+
+    def _get_media_client(self, endpoint_url):
+        '''
+        Returns the KVS Media client for the given data endpoint, creating it only the first time.
+
+        ### Parameters:
+            **endpoint_url**: str
+                KVS data endpoint as returned by _get_data_endpoint.
+        '''
+        if endpoint_url not in self._media_clients:
+            self._media_clients[endpoint_url] = self.session.client('kinesis-video-media', endpoint_url=endpoint_url,
+                                                                    config=KVS_CLIENT_CONFIG)
+        return self._media_clients[endpoint_url]
 
 if __name__ == "__main__":
     kvsConsumerExample = KvsPythonConsumer()